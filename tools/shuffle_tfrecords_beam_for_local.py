@@ -74,10 +74,13 @@ from __future__ import print_function
 
 import argparse
 import logging
-import glob
+import textwrap
 
 import apache_beam as beam
 from apache_beam import coders
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions
 import os
 
@@ -126,17 +129,18 @@ def parse_cmdline(argv):
     default=1,
     type=int,
   )
+  parser.add_argument(
+    '--num_output_shards',
+    help="Number of shards for the output TFRecords",
+    default=os.cpu_count(),
+    type=int,
+  )
   parser.add_argument(
     "--pre_partition",
     help="Pre-partition the input data into buckets",
     default=False,
     action="store_true",
   )
-  parser.add_argument(
-    "--pre_partition_workdir",
-    help="Pre-partition work directory",
-    required=False,
-  )
   parser.add_argument(
     "--debug",
     help="Enable debug messages", action="store_true", default=False,
@@ -145,7 +149,6 @@ def parse_cmdline(argv):
   known_args, pipeline_args = parser.parse_known_args(argv)
 
   if known_args.pre_partition:
-    assert(known_args.pre_partition_workdir is not None), "Provide working directory for pre-partition"
     assert(known_args.num_buckets > 0), "Minimum of one bucket should be provided for pre-partition"
 
   return known_args, pipeline_args
@@ -153,127 +156,91 @@ def parse_cmdline(argv):
 
 def partition(example, num_buckets):
   """ Partition examples into multiple buckets """
-  def determine_hash(input_bytes):
-    import hashlib
-    m = hashlib.blake2b(input_bytes, digest_size=4)
-    address = 0
-    for i, b in enumerate(m.digest()):
-      address += b * (2 ** (i * 8))
-    return address
+  # SparkRunner requires this to be a lazy/local import
+  import xxhash
+  return xxhash.xxh3_64_intdigest(example) % num_buckets
 
-  address = determine_hash(example)
-  bucket = address % num_buckets
-  return bucket
 
+def read_from_tfrecords_files(pipeline, input_filename_pattern_list):
+  """Reads records from TFRecord files.
 
-def pre_partition(input_pattern, working_directory, pipeline_args, num_buckets):
+  Args:
+    pipeline: Beam pipeline object.
+    input_filename_pattern_list: List of filename patterns.
+
+  Returns:
+    A PCollection of read tf.Examples.
   """
-  Pre-partition data
+  # ReadAllFromTFRecord expands the patterns itself and fans the reads out
+  # dynamically, so the graph stays a single stage however many patterns
+  # are given
+  return (pipeline
+          | 'CreateFilePatterns' >> beam.Create(input_filename_pattern_list)
+          | 'ReadAllTFRecordFiles' >> beam.io.ReadAllFromTFRecord(
+              coder=coders.BytesCoder()))
+
+
+def shuffle_records(input_examples, name=''):
+  """Shuffles the input_examples in a effectively random order.
+
+  Args:
+    input_examples: PCollection of examples to shuffle.
+    name: Optional label suffix so the transform can be applied to several
+      PCollections within one pipeline.
   """
-  if os.path.exists(working_directory):
-    raise ValueError("Provide a clean working directory path directory")
+  # Reshuffle assigns its own random keys internally, so no explicit
+  # per-record keying pass is needed
+  return input_examples | 'Reshuffle%s' % name >> beam.Reshuffle()
 
-  os.makedirs(working_directory)
 
-  logging.info("Initiating pre-partitioning")
+class CountRecords(beam.DoFn):
+  """Passes records through while counting them with a metrics counter."""
 
-  with beam.Pipeline(options=PipelineOptions(pipeline_args)) as pipeline:
-    input_data = read_from_tfrecords_files(pipeline, input_pattern)
-    partitions = input_data | "PrePartition" >> beam.Partition(partition, num_buckets)
-    for i, p in enumerate(partitions):
-      write = p | "WritePartition%d" % i >> beam.io.WriteToTFRecord(
-        file_path_prefix=os.path.join(
-          working_directory, "partition%04d" % i), file_name_suffix=".tfrecord.gz", coder=coders.BytesCoder()
-        )
+  COUNTER_NAMESPACE = 'shuffle_tfrecords'
+  COUNTER_NAME = 'num_examples'
 
-  filenames = glob.glob(os.path.join(working_directory, "partition????-00000-of-00001.tfrecord.gz"))
-  return filenames
+  def __init__(self):
+    self.num_examples = Metrics.counter(
+        self.COUNTER_NAMESPACE, self.COUNTER_NAME)
 
+  def process(self, input_bytes):
+    self.num_examples.inc()
+    yield input_bytes
 
-def read_from_tfrecords_files(pipeline, input_filename_pattern_list):
-  """Reads records from TFRecord files.
 
-  Args:
-    pipeline: Beam pipeline object.
-    input_filename_pattern_list: List of filename patterns.
+def get_num_examples(pipeline_result):
+  """Returns the number of records counted by CountRecords in a run."""
+  counter_filter = (
+      MetricsFilter()
+      .with_namespace(CountRecords.COUNTER_NAMESPACE)
+      .with_name(CountRecords.COUNTER_NAME))
+  counters = pipeline_result.metrics().query(counter_filter)['counters']
+  return sum(counter.result for counter in counters)
 
-  Returns:
-    A PCollection of read tf.Examples.
-  """
-  readers = []
-  for i, filepattern in enumerate(input_filename_pattern_list):
-    readers.append(pipeline
-                   | 'ReadTFRecordFiles_{}[{}]'.format(i, filepattern) >> beam
-                   .io.ReadFromTFRecord(filepattern, coder=coders.BytesCoder()))
-  all_readers = readers | 'Flatten' >> beam.Flatten()
-  return all_readers
-
-
-def shuffle_records(input_examples):
-  """Shuffles the input_examples in a effectively random order."""
-
-  def sha1(input_bytes):
-    """Returns the sha1 hash of input_bytes."""
-    # SparkRunner requires this to be a lazy/local import
-    import hashlib
-    m = hashlib.sha1()
-    m.update(input_bytes)
-    return m.digest()
-
-  return (input_examples
-          | 'Randomize' >> beam.Map(lambda x: (sha1(x), x))
-          | 'Groupby' >> beam.GroupByKey()
-          | 'DropKey' >> beam.FlatMap(lambda x: x[1]))
-
-
-# SparkRunner has some issue with using lambda functions in beam.Map
-# Hence, this has been turned into a callable
-class MakeConfigStringCaller:
-  def __init__(self, dataset_name, output_pattern_prefix):
-    self.name = dataset_name
-    self.tfrecord_path = output_pattern_prefix
-
-  def __call__(self, num_examples):
-    # SparkRunner requires this to be a lazy/local import
-    import textwrap
-    return textwrap.dedent("""
-    name: "{}"
-    tfrecord_path: "{}-?????-of-?????.tfrecord.gz"
-    num_examples: {}
-    """.format(self.name, self.tfrecord_path, num_examples))
-
-
-def write_summary_string_to_file(pipeline, output_examples, input_pattern_list,
+
+def write_summary_string_to_file(num_examples, input_pattern_list,
                                  dataset_name, output_pattern_prefix,
                                  output_filename):
-  """Writes a file summarizing the PCollection of Examples.
+  """Writes a file summarizing the shuffled examples.
 
   Args:
-    pipeline: Beam pipeline object.
-    output_examples: PCollection of examples.
+    num_examples: int. The number of examples in the shuffled output.
     input_pattern_list: str. A comma-separated string of input files.
     dataset_name: str. The name of the dataset to be written in the output.
     output_pattern_prefix: str. The prefix of the sharded output files.
     output_filename: the output text file that contains the summary that can be
       parsed into DeepVariantDatasetConfig.
   """
+  summary = COMMENT_HEADER.format(input_pattern_list, output_pattern_prefix)
+  summary += textwrap.dedent("""
+  name: "{}"
+  tfrecord_path: "{}-?????-of-?????.tfrecord.gz"
+  num_examples: {}
+  """.format(dataset_name, output_pattern_prefix, num_examples))
 
-  # Beam currently has no way to materialize pipeline values, so we have
-  # to construct the file entirely in Beam pipeline operations.
-  comment_str = pipeline | 'CreateFileHeader' >> beam.Create(
-      [COMMENT_HEADER.format(input_pattern_list, output_pattern_prefix)])
-  num_examples = (
-      output_examples
-      | 'CountOutputExamples' >> beam.combiners.Count.Globally())
-  config_str = num_examples | 'MakeConfigStr' >> beam.Map(
-      MakeConfigStringCaller(dataset_name, output_pattern_prefix))
-
-  merged_strings = (comment_str, config_str) | 'FlattenStrs' >> beam.Flatten()
-  _ = (
-      merged_strings
-      | 'Concat2' >> beam.CombineGlobally(''.join)
-      | 'WriteToFile' >> beam.io.WriteToText(
-          output_filename, shard_name_template=''))
+  # FileSystems keeps this working for gs:// outputs as well
+  with FileSystems.create(output_filename) as f:
+    f.write(summary.encode('utf-8'))
 
 
 def main(argv=None):
@@ -284,56 +251,46 @@ def main(argv=None):
   else:
     logging.getLogger().setLevel(logging.INFO)
 
-  # Prepartition files
-  if known_args.pre_partition:
-    input_files = pre_partition(
-      known_args.input_pattern_list.split(","), known_args.pre_partition_workdir, pipeline_args, known_args.num_buckets
-    )
-  else:
-    input_files = [known_args.input_pattern_list]
+  if known_args.output_dataset_config_pbtxt and not known_args.output_dataset_name:
+    raise ValueError('Need to set output_dataset_name.')
 
-  # Shuffle each partition
+  # Read, optionally pre-partition, shuffle and write in a single pipeline,
+  # without any intermediate files
   pipeline_options = PipelineOptions(pipeline_args)
-  output_patterns = []
-  
-  for i, filename in enumerate(input_files):
-    with beam.Pipeline(options=pipeline_options) as p:
-      input_examples = read_from_tfrecords_files(
-          p, filename.split(","))
 
+  with beam.Pipeline(options=pipeline_options) as p:
+    input_examples = read_from_tfrecords_files(
+        p, known_args.input_pattern_list.split(","))
+
+    # A single bucket is just the identity partition, so only go through
+    # the Partition/Flatten path when it yields more than one bucket
+    if known_args.pre_partition and known_args.num_buckets > 1:
+      partitions = input_examples | "PrePartition" >> beam.Partition(
+          partition, known_args.num_buckets)
+      shuffled = [
+          shuffle_records(part, name="Partition%d" % i)
+          for i, part in enumerate(partitions)
+      ]
+      output_examples = shuffled | "FlattenPartitions" >> beam.Flatten()
+    else:
       output_examples = shuffle_records(input_examples)
-      output_pattern_prefix = known_args.output_pattern_prefix + "_partition%d" % i
-      output_patterns.append(
-        output_pattern_prefix + "-?????-of-?????.tfrecord.gz"
-      )
 
-      _ = output_examples | beam.io.WriteToTFRecord(
-          file_path_prefix=output_pattern_prefix,
-          file_name_suffix='.tfrecord.gz',
-          coder=coders.BytesCoder())
-
-  # Combine shuffled partitions into a single set of output files
-  with beam.Pipeline(options=pipeline_options) as p:
-    output_examples = read_from_tfrecords_files(p, output_patterns)
+    output_examples = (
+        output_examples
+        | 'CountOutputExamples' >> beam.ParDo(CountRecords()))
     write_outputs = output_examples | "WriteOutputs" >> beam.io.WriteToTFRecord(
       file_path_prefix=known_args.output_pattern_prefix,
       file_name_suffix=".tfrecord.gz",
+      num_shards=known_args.num_output_shards,
       coder=coders.BytesCoder(),
     )
 
-    if known_args.output_dataset_config_pbtxt:
-      if not known_args.output_dataset_name:
-        raise ValueError('Need to set output_dataset_name.')
-      write_summary_string_to_file(p, output_examples,
-                                   known_args.input_pattern_list,
-                                   known_args.output_dataset_name,
-                                   known_args.output_pattern_prefix,
-                                   known_args.output_dataset_config_pbtxt)
-
-  # Cleanup
-  for pattern in output_patterns:
-    for partial in glob.glob(pattern):
-      os.remove(partial)
+  if known_args.output_dataset_config_pbtxt:
+    write_summary_string_to_file(get_num_examples(p.result),
+                                 known_args.input_pattern_list,
+                                 known_args.output_dataset_name,
+                                 known_args.output_pattern_prefix,
+                                 known_args.output_dataset_config_pbtxt)
 
 
 if __name__ == '__main__':